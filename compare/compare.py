@@ -5,7 +5,6 @@ import koji
 import argparse
 import datetime
 import jinja2
-import json
 import logging
 import os
 import re
@@ -13,8 +12,49 @@ import requests
 import rpm
 import sys
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from requests.adapters import HTTPAdapter
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 SCRIPTPATH = os.path.dirname(os.path.realpath(__file__))
 
+ARCHES = ("aarch64", "ppc64le", "s390x", "x86_64")
+SOURCES = ("source", "buildroot-source")
+
+PLACEHOLDER_URL = (
+    "{distro_url}"
+    "/view-placeholder-srpm-details--view-{distro_view}--{arch}.json"
+)
+PACKAGE_LIST_URL = (
+    "{distro_url}"
+    "/view-{this_source}-package-name-list--view-{distro_view}--{arch}.txt"
+)
+
+# Share keep-alive connections to the Content Resolver between all downloads
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Number of Content Resolver files downloaded concurrently
+FETCH_WORKERS = 8
+
+# Keep the XMLRPC connection to the hub open between calls
+KOJI_OPTS = {"keepalive": True, "timeout": 300}
+
+# Number of Koji calls sent in a single multicall request
+KOJI_BATCH = 500
+
+# Statuses counted in the main statistics
+MSTATS = frozenset(["SAME", "NEW", "OLD", "NONE", "ERROR"])
+
+# Dist tag part of a release, e.g. ".fc34", ".eln108" or ".el9"
+DIST_TAG_RE = re.compile(r"\.(?:fc|eln|el)[0-9]*")
+
 class BuildSource:
     def __init__(
         self,
@@ -54,22 +94,22 @@ class BuildSource:
         distro_url = "https://tiny.distro.builders"
         distro_view = "eln"
         if source_id == "rawhide":
-            infra = koji.ClientSession('https://koji.fedoraproject.org/kojihub')
+            infra = koji.ClientSession('https://koji.fedoraproject.org/kojihub', opts=dict(KOJI_OPTS))
             tag = infra.getFullInheritance('rawhide')[0]['name']
             tag2 = None
             product = "Rawhide"
         if source_id == "fedora":
-            infra = koji.ClientSession('https://koji.fedoraproject.org/kojihub')
+            infra = koji.ClientSession('https://koji.fedoraproject.org/kojihub', opts=dict(KOJI_OPTS))
             tag = "f34-cr-eln"
             tag2 = None
             product = "Fedora34"
         if source_id == "eln":
-            infra = koji.ClientSession('https://koji.fedoraproject.org/kojihub')
+            infra = koji.ClientSession('https://koji.fedoraproject.org/kojihub', opts=dict(KOJI_OPTS))
             tag = "eln"
             tag2 = None
             product = "ELN"
         if source_id == "stream":
-            infra = koji.ClientSession('https://kojihub.stream.rdu2.redhat.com/kojihub')
+            infra = koji.ClientSession('https://kojihub.stream.rdu2.redhat.com/kojihub', opts=dict(KOJI_OPTS))
             # FIXME?
             tag = "c9s-gate"
             tag2 = "c9s-pending"
@@ -78,7 +118,7 @@ class BuildSource:
             distro_view = "c9s"
         if source_id == "rhel":
             # FIXME
-            infra = koji.ClientSession('https://brewhub.engineering.redhat.com/brewhub')
+            infra = koji.ClientSession('https://brewhub.engineering.redhat.com/brewhub', opts=dict(KOJI_OPTS))
             tag = "rhel-9.0.0-alpha-candidate"
             tag2 = "rhel-9.0.0-beta-candidate"
             product = "RHEL9"
@@ -108,6 +148,23 @@ class BuildSource:
         else:
             return None
 
+    def prefetch(self, packages):
+        """Fetch the latest builds of the given packages in batched Koji calls
+
+        Populate the cache only with the packages which have builds in the tag.
+        """
+
+        logging.debug(f'Prefetch {len(packages)} packages for {self}...')
+        with self.infra.multicall(batch=KOJI_BATCH) as m:
+            calls = {
+                package: m.listTagged(self.tag, package=package, latest=True)
+                for package in packages
+            }
+        for package, call in calls.items():
+            if call.result:
+                self.cache[package] = call.result[0]
+        logging.debug(f'Done prefetching for {self}')
+
     def make_cache(self):
         """Fetch all builds from tag"""
 
@@ -143,34 +200,35 @@ class Comparison:
     }
 
     def __init__(self, content, source1, source2):
-        self.content = content
+        self.content = frozenset(content)
         self.source1 = source1
         self.source2 = source2
 
         distro_url = source2.distro_url
         distro_view = source2.distro_view
-        arches = ["aarch64", "ppc64le", "s390x", "x86_64"]
 
         # Setup PackagePlaceholder package list
-        self.pplace_packagelist = []
-
-        for arch in arches:
-            placeholderJsonData = {}
-            placeholderURL = (
-                "{distro_url}"
-                "/view-placeholder-srpm-details--view-{distro_view}--{arch}.json"
-            ).format(distro_url=distro_url, distro_view=distro_view, arch=arch)
-            placeholderJsonData = json.loads(requests.get(placeholderURL, allow_redirects=True).text)
+        self.pplace_packagelist = set()
+
+        placeholderURLs = [
+            PLACEHOLDER_URL.format(distro_url=distro_url, distro_view=distro_view, arch=arch)
+            for arch in ARCHES
+        ]
+
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            responses = executor.map(SESSION.get, placeholderURLs)
+
+        for r in responses:
+            placeholderJsonData = json_loads(r.content)
             for placeholder_source in placeholderJsonData:
                 logging.debug(f'Placeholder {placeholder_source} put on list')
-                if not placeholder_source in self.pplace_packagelist:
-                    self.pplace_packagelist.append(placeholder_source)
+            self.pplace_packagelist.update(placeholderJsonData)
 
         # The nosync list should be coming from the distrobaker config yaml file 
         # https://gitlab.cee.redhat.com/osci/distrobaker_config/-/raw/rhel9/distrobaker.yaml
         # For now just use a flat file
         nosync_f = os.path.join(SCRIPTPATH, "lists", "nosync.txt")
-        self.nosync_packagelist = open(nosync_f).read().splitlines()
+        self.nosync_packagelist = read_package_list(nosync_f)
 
         self.results = {}
 
@@ -179,12 +237,9 @@ class Comparison:
 
         Return dictionary with items: status, nvr1, nvr2.
         """
-        if package not in content:
+        if package not in self.content:
             logging.warning(f'Package {package} is not in the content set')
 
-        if package in self.results:
-            return self.results[package]
-
         build1 = self.source1.get_build(package)
         build2 = self.source2.get_build(package)
 
@@ -248,33 +303,27 @@ class Comparison:
         return extras
 
     def compare_content(self):
-        for package in self.pplace_packagelist:
-            logging.debug(f'Processing package {package}')
-            self.results[package] = self.compare_one(package)
-        for package in content:
+        packages = self.pplace_packagelist | self.content
+        for source in (self.source1, self.source2):
+            if not source.cache:
+                source.prefetch(packages)
+
+        for package in sorted(packages):
             logging.debug(f'Processing package {package}')
             self.results[package] = self.compare_one(package)
         return self.results
 
     def count(self):
-        stats = {}
-        for item in self.results.values():
-            value = item["status"]
-            if value not in stats:
-                stats[value] = 0
-            stats[value] += 1
+        # plain dict, templates read stats.total which Counter shadows with a method
+        stats = dict(Counter(item["status"] for item in self.results.values()))
         stats["total"] = sum(stats.values())
         return stats
 
     def mcount(self):
-        mstats = {}
-        mstats_list = ["SAME","NEW","OLD","NONE","ERROR"]
-        for item in self.results.values():
-            value = item["status"]
-            if value in mstats_list:
-                if value not in mstats:
-                    mstats[value] = 0
-                mstats[value] += 1
+        mstats = dict(Counter(
+            item["status"] for item in self.results.values()
+            if item["status"] in MSTATS
+        ))
         mstats["total"] = sum(mstats.values())
         return mstats
 
@@ -322,6 +371,15 @@ class Comparison:
             )
 
 
+def read_package_list(path):
+    """Read a flat file with one package name per line
+
+    Return set of the package names, skipping empty lines.
+    """
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
 def get_content(distro_url="https://tiny.distro.builders", distro_view="eln"):
     """Builds the full list of packages for the distro from the Content Resolver
 
@@ -329,31 +387,30 @@ def get_content(distro_url="https://tiny.distro.builders", distro_view="eln"):
     """
     merged_packages = set()
 
-    arches = ["aarch64", "ppc64le", "s390x", "x86_64"]
-    which_source = ["source", "buildroot-source"]
-
     # excludes should be changed to a URL / git repo somewhere
     # Currently they are variables in eln-periodic.py
     # For now just use a flat file
     exclude_f = os.path.join(SCRIPTPATH, "lists", "exclude.txt")
-    exclude_packagelist = open(exclude_f).read().splitlines()
+    exclude_packagelist = read_package_list(exclude_f)
+
+    urls = [
+        PACKAGE_LIST_URL.format(
+            distro_url=distro_url, this_source=this_source, distro_view=distro_view, arch=arch
+        )
+        for arch in ARCHES
+        for this_source in SOURCES
+    ]
+
+    for url in urls:
+        logging.debug("downloading {url}".format(url=url))
 
-    for arch in arches:
-        for this_source in which_source:
-            url = (
-                "{distro_url}"
-                "/view-{this_source}-package-name-list--view-{distro_view}--{arch}.txt"
-            ).format(distro_url=distro_url, this_source=this_source, distro_view=distro_view, arch=arch)
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        responses = executor.map(SESSION.get, urls)
 
-            logging.debug("downloading {url}".format(url=url))
+    for r in responses:
+        merged_packages.update(line for line in r.text.splitlines() if line)
 
-            r = requests.get(url, allow_redirects=True)
-            for line in r.text.splitlines():
-                if not line:
-                    continue
-                if line in exclude_packagelist:
-                    continue
-                merged_packages.add(line)
+    merged_packages -= exclude_packagelist
 
     logging.debug("Found a total of {} packages".format(len(merged_packages)))
 
@@ -373,8 +430,7 @@ def evr(build):
     epoch = "0"
 
     version = build['version']
-    p = re.compile(".(fc|eln|el)[0-9]*")
-    release = re.sub(p, "", build['release'])
+    release = DIST_TAG_RE.sub("", build['release'])
 
     return (epoch, version, release)
 
@@ -471,19 +527,19 @@ if __name__ == "__main__":
     C.render(output_path=args.output, tmpl_path=args.templates, fmt=args.format)
 
     with open("content.txt", "w") as f:
-        for pkg_name in content:
-            f.write(pkg_name + "\n")
-
-    results = C.results_by_status()
-
-    with open("untag.txt", "w") as f:
-        for pkg_info in results.get("EXTRA", []):
-            f.write(pkg_info[2] + "\n")
-
-    with open("rebuild.txt", "w") as f:
-        for pkg_info in results.get("NONE", []) + results.get("OLD", []):
-            f.write(pkg_info[1] + "\n")
-
-    with open("ftbfs.txt", "w") as f:
-        for pkg_info in results.get("NONE", []):
-            f.write(pkg_info[0] + "\n")
+        f.writelines(pkg_name + "\n" for pkg_name in content)
+
+    with ExitStack() as stack:
+        untag_f = stack.enter_context(open("untag.txt", "w"))
+        rebuild_f = stack.enter_context(open("rebuild.txt", "w"))
+        ftbfs_f = stack.enter_context(open("ftbfs.txt", "w"))
+
+        for pkg_name, info in C.results.items():
+            status = info["status"]
+            if status == "EXTRA":
+                untag_f.write(info["nvr2"] + "\n")
+            elif status == "OLD":
+                rebuild_f.write(info["nvr1"] + "\n")
+            elif status == "NONE":
+                rebuild_f.write(info["nvr1"] + "\n")
+                ftbfs_f.write(pkg_name + "\n")
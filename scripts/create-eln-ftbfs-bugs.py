@@ -7,19 +7,37 @@
 import bugzilla
 import click
 import getpass
+import hashlib
+import io
+import json
 import koji
 import logging
 import os
+import requests
 import sys
-import urllib
-import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from xmlrpc.client import Fault
 
+from file_cache import CACHE_ROOT, write_file_atomic
+
 
 LOGGER = logging.getLogger(os.path.basename(__file__))
 DRY_RUN = None
 
+# number of Koji calls sent in a single multicall request
+KOJI_BATCH = 500
+
+KOJI_TASK_FAILED = koji.TASK_STATES["FAILED"]  # 5 == Failed
+
+# keep-alive connections to kojipkgs, shared by all log downloads
+LOG_SESSION = requests.Session()
+LOG_SESSION.mount("https://", HTTPAdapter(pool_maxsize=3))
+
+CACHE_DIR = os.path.join(CACHE_ROOT, "eln-ftbfs")
+
 config = {
     "eln_tracking_bug": "ELNFTBFS",
     "product": "Fedora",
@@ -47,19 +65,67 @@ def get_filed_bugs(bz, tracking_bug):
     # lookup the tracking bug first in case it is an alias
     tbug = bz.getbug(tracking_bug)
 
-    query = bz.build_query(blocked=str(tbug.id))
+    # only fetch the fields used by the caller, so that reading them later
+    # does not trigger a refresh of each bug
+    query = bz.build_query(
+        blocked=str(tbug.id), include_fields=["id", "component", "status"]
+    )
     return bz.query(query)
 
 
-def get_comps_subcomp(bz, config):
+def read_cache(name, ttl):
+    """Return the data cached under the given name, or None if there is no
+    such data or it is older than ttl seconds.
+
+    arguments:
+    name -- file name of the cache entry
+    ttl -- maximum age of the cache entry in seconds
+    """
+    path = os.path.join(CACHE_DIR, name)
+    try:
+        if time.time() - os.path.getmtime(path) >= ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(name, data):
+    """Atomically replace the data cached under the given name. The cache is
+    only an optimization, so failing to write it is logged and ignored.
+
+    arguments:
+    name -- file name of the cache entry
+    data -- JSON serializable data
+    """
+    try:
+        write_file_atomic(os.path.join(CACHE_DIR, name), json.dumps(data))
+    except OSError as e:
+        LOGGER.warning("Could not write cache {}: {}".format(name, e))
+
+
+def get_comps_subcomp(bz, config, cache_ttl=0):
     """Query bugzilla for all product components and sub-components.
     Return a dictionary mapping each component to its first sub-component,
     or None if has none.
 
     arguments:
     bz -- bugzilla client
-    tracking_bug -- bug used to track failures
+    config -- generic info such as the rhel_product to query
+    cache_ttl -- reuse a map cached on disk if younger than this many seconds
     """
+    # the same product may have different components on another Bugzilla
+    cache_key = "{} {}".format(bz.url, config["rhel_product"])
+    cache_name = "components-{}.json".format(
+        hashlib.sha1(cache_key.encode()).hexdigest()
+    )
+    if cache_ttl > 0:
+        comps_dict = read_cache(cache_name, cache_ttl)
+        if comps_dict is not None:
+            LOGGER.debug("Using cached component:sub-component map")
+            return comps_dict
+
     LOGGER.debug(
         "Querying for product {} sub-components".format(config["rhel_product"])
     )
@@ -81,6 +147,9 @@ def get_comps_subcomp(bz, config):
             comp["sub_components"][0]["name"] if comp["sub_components"] else None
         )
 
+    if cache_ttl > 0:
+        write_cache(cache_name, comps_dict)
+
     LOGGER.debug("Returning component:sub-component map:\n{}".format(comps_dict))
     return comps_dict
 
@@ -188,8 +257,7 @@ def report_failure(
     try:
         print("Creating the bug report")
         bug = bz.createbug(**data)
-        bug.refresh()
-        print(bug)
+        print("Created BZ#{} for package {}".format(bug.id, component))
         if priv_update:
             bz.update_bugs([bug.id], priv_update)
         attach_logs(bz, bug, logs)
@@ -201,45 +269,87 @@ def report_failure(
     return bug
 
 
+def fetch_log_tail(log, limit):
+    """Download at most the last 'limit' bytes of a log
+
+    Return a tuple of the downloaded bytes and the full size of the log.
+
+    arguments:
+    log -- URL of the log
+    limit -- maximum number of bytes to return
+    """
+    # ask only for the tail of the log, uncompressed so that its size is
+    # bounded by the limit. A missing log fails this request as cheaply as
+    # a separate HEAD probe would, so there is no extra round trip for it.
+    response = LOG_SESSION.get(
+        log,
+        headers={"Range": "bytes=-{}".format(limit), "Accept-Encoding": "identity"},
+        stream=True,
+        timeout=60,
+    )
+
+    with response:
+        # an empty log cannot satisfy any range
+        if response.status_code == 416:
+            return b"", 0
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            data = response.raw.read(limit)
+            # Content-Range is "bytes <first>-<last>/<size>"
+            size = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            return data, int(size) if size.isdigit() else len(data)
+
+        # the server ignored the range, keep only the tail of the full log
+        CHUNK = 2 ** 20
+        tail = bytearray()
+        size = 0
+        for chunk in response.iter_content(CHUNK):
+            size += len(chunk)
+            tail += chunk[-limit:]
+            # drop everything but the last 'limit' bytes in place
+            del tail[:-limit]
+        return bytes(tail), size
+
+
 def attach_logs(bz, bug, logs):
 
     if isinstance(bug, int):
         bug = bz.getbug(bug)
 
-    for log in logs:
+    # Bugzilla file limit, still possibly too much
+    # FILELIMIT = 32 * 1024
+    # Just use 32 KiB:
+    FILELIMIT = 2 ** 15
+
+    if not logs:
+        return
+
+    # the logs are independent downloads, fetch them all at once and
+    # attach them in order afterwards
+    with ThreadPoolExecutor(max_workers=len(logs)) as executor:
+        tails = [executor.submit(fetch_log_tail, log, FILELIMIT) for log in logs]
+
+    for log, tail in zip(logs, tails):
         name = log.rsplit("/", 1)[-1]
         try:
-            response = urllib.request.urlopen(log)
-        except urllib.error.HTTPError as e:
+            data, filesize = tail.result()
+        except requests.HTTPError as e:
             # sometimes there wont be any logs attached to the task.
             # skip attaching logs for those tasks
-            if e.code == 404:
+            if e.response.status_code == 404:
                 print("Failed to attach {} log".format(name))
                 continue
             else:
                 break
-        fp = tempfile.TemporaryFile()
 
-        CHUNK = 2 ** 20
-        while True:
-            chunk = response.read(CHUNK)
-            if not chunk:
-                break
-            fp.write(chunk)
-
-        filesize = fp.tell()
-        # Bugzilla file limit, still possibly too much
-        # FILELIMIT = 32 * 1024
-        # Just use 32 KiB:
-        FILELIMIT = 2 ** 15
         if filesize > FILELIMIT:
-            fp.seek(filesize - FILELIMIT)
             comment = "file {} too big, only attached last {} bytes".format(
                 name, FILELIMIT
             )
         else:
             comment = ""
-            fp.seek(0)
+        fp = io.BytesIO(data)
         try:
             print("Attaching file %s to the ticket" % name)
             # arguments are: idlist, attachfile, description, ...
@@ -260,36 +370,19 @@ def attach_logs(bz, bug, logs):
             fp.close()
 
 
-def get_failed_subtask(kojisession, task_id):
-    """For a given build task_id, return the
+def get_failed_subtask(children):
+    """For the children of a build task, return the
     task_id of the first child that failed to build.
     """
-    for child in kojisession.getTaskChildren(task_id):
-        if child["state"] == koji.TASK_STATES["FAILED"]:  # 5 == Failed
-            return child["id"]
-    return 0
-
-
-def get_koji_failed_build_taskid(ks, pkgname, release_filter, epoch):
-    LOGGER.debug("get_koji_failed_build_taskid(pkgname={}) called".format(pkgname))
-
-    pkgid = ks.getPackageID(pkgname)
-
-    LOGGER.debug("Koji packageID for {} is {}".format(pkgname, pkgid))
-
-    failed_builds = ks.listBuilds(
-        packageID=pkgid,
-        state=koji.BUILD_STATES["FAILED"],
-        taskID=-1,
-        createdAfter=epoch,
+    return next(
+        (child["id"] for child in children if child["state"] == KOJI_TASK_FAILED), 0
     )
 
-    LOGGER.debug(
-        "Koji query returned {} failed builds created after {}:\n{}".format(
-            len(failed_builds), epoch, failed_builds
-        )
-    )
 
+def get_latest_failed_taskid(failed_builds, release_filter):
+    """Return the task_id of the latest failed build matching release_filter,
+    or 0 if there is none.
+    """
     # assume taskIDs are monotonically increasing...
     latest_failed_taskid = 0
     for build in failed_builds:
@@ -299,17 +392,79 @@ def get_koji_failed_build_taskid(ks, pkgname, release_filter, epoch):
             continue
         latest_failed_taskid = build["task_id"]
 
-    LOGGER.debug("Latest failed build taskid is {}".format(latest_failed_taskid))
+    return latest_failed_taskid
+
 
-    if not latest_failed_taskid:
-        LOGGER.warning("Could not locate a failed build for package {}".format(pkgname))
-        return 0
+def get_koji_failed_build_taskids(ks, pkgnames, release_filter, epoch):
+    """For each package, find the first failed subtask of its latest failed
+    build. The Koji lookups for all packages are batched into multicalls.
 
-    subtask = get_failed_subtask(ks, latest_failed_taskid)
+    Return a dictionary mapping each package name to the subtask id, or 0 if
+    no failed build could be found.
+    """
+    LOGGER.debug("get_koji_failed_build_taskids(pkgnames={}) called".format(pkgnames))
+
+    with ks.multicall(batch=KOJI_BATCH) as m:
+        pkgid_calls = {pkgname: m.getPackageID(pkgname) for pkgname in pkgnames}
+
+    pkgids = {pkgname: call.result for pkgname, call in pkgid_calls.items()}
 
-    LOGGER.debug("First detected subtask failure is {}".format(subtask))
+    LOGGER.debug("Koji packageIDs: {}".format(pkgids))
 
-    return subtask
+    # without a packageID listBuilds would return the failed builds of
+    # all packages, so skip those not known to Koji
+    with ks.multicall(batch=KOJI_BATCH) as m:
+        builds_calls = {
+            pkgname: m.listBuilds(
+                packageID=pkgid,
+                state=koji.BUILD_STATES["FAILED"],
+                taskID=-1,
+                createdAfter=epoch,
+            )
+            for pkgname, pkgid in pkgids.items()
+            if pkgid is not None
+        }
+
+    latest_failed_taskids = {}
+    for pkgname in pkgnames:
+        failed_builds = builds_calls[pkgname].result if pkgname in builds_calls else []
+
+        LOGGER.debug(
+            "Koji query returned {} failed builds of {} created after {}:\n{}".format(
+                len(failed_builds), pkgname, epoch, failed_builds
+            )
+        )
+
+        latest_failed_taskid = get_latest_failed_taskid(failed_builds, release_filter)
+
+        LOGGER.debug(
+            "Latest failed build taskid of {} is {}".format(pkgname, latest_failed_taskid)
+        )
+
+        if not latest_failed_taskid:
+            LOGGER.warning("Could not locate a failed build for package {}".format(pkgname))
+            continue
+
+        latest_failed_taskids[pkgname] = latest_failed_taskid
+
+    with ks.multicall(batch=KOJI_BATCH) as m:
+        children_calls = {
+            pkgname: m.getTaskChildren(taskid)
+            for pkgname, taskid in latest_failed_taskids.items()
+        }
+
+    subtasks = {}
+    for pkgname in pkgnames:
+        if pkgname in children_calls:
+            subtask = get_failed_subtask(children_calls[pkgname].result)
+            LOGGER.debug(
+                "First detected subtask failure of {} is {}".format(pkgname, subtask)
+            )
+        else:
+            subtask = 0
+        subtasks[pkgname] = subtask
+
+    return subtasks
 
 
 def get_koji_task_logs(ks, taskid):
@@ -364,6 +519,13 @@ def listify(list_or_simple):
     show_default=True,
     default=True,
 )
+@click.option(
+    "--rest/--xmlrpc",
+    is_flag=True,
+    help="Talk to Bugzilla over its REST API instead of the legacy XMLRPC one",
+    show_default=True,
+    default=True,
+)
 @click.option(
     "--api-key", type=str, help="Bugzilla API key", show_default=True, default=None,
 )
@@ -380,15 +542,24 @@ def listify(list_or_simple):
     show_default=True,
     default="F34FTBFS",
 )
+@click.option(
+    "--cache-ttl",
+    type=int,
+    help="Seconds to reuse the Bugzilla component map cached on disk, 0 disables",
+    show_default=True,
+    default=3600,
+)
 def cli(
     debug,
     dry_run,
     input_file,
     bugzilla_url,
     sslverify,
+    rest,
     api_key,
     internal_eln_ftbfs_url,
     rawhide_tracking_bug,
+    cache_ttl,
 ):
 
     global DRY_RUN
@@ -411,9 +582,19 @@ def cli(
 
     # establish Bugzilla client session
     LOGGER.debug("Creating Bugzilla session using instance {}".format(bugzilla_url))
-    bz = bugzilla.Bugzilla(
-        url="{}/xmlrpc.cgi".format(bugzilla_url), sslverify=sslverify, api_key=api_key
-    )
+    if rest:
+        bz = bugzilla.Bugzilla(
+            url="{}/rest/".format(bugzilla_url),
+            sslverify=sslverify,
+            api_key=api_key,
+            force_rest=True,
+        )
+    else:
+        bz = bugzilla.Bugzilla(
+            url="{}/xmlrpc.cgi".format(bugzilla_url),
+            sslverify=sslverify,
+            api_key=api_key,
+        )
     if not bz.logged_in:
         print("Bugzilla login failed. Bye bye.")
         sys.exit(1)
@@ -435,10 +616,19 @@ def cli(
     )
     LOGGER.debug("Need to make sure bugs are filed for: {}".format(ftbfs_pkg_list))
 
+    # the tracking bug and component queries are independent, run them at once
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        eln_filed_bugs = executor.submit(
+            get_filed_bugs, bz, config["eln_tracking_bug"]
+        )
+        rawhide_filed_bugs = executor.submit(get_filed_bugs, bz, rawhide_tracking_bug)
+        comps_subcomp = executor.submit(get_comps_subcomp, bz, config, cache_ttl)
+
     # get previously filed BZs
-    filed_bugs = get_filed_bugs(bz, config["eln_tracking_bug"])
     eln_filed_bugs_components = {
-        comp: bug.id for bug in filed_bugs for comp in listify(bug.component)
+        comp: bug.id
+        for bug in eln_filed_bugs.result()
+        for comp in listify(bug.component)
     }
 
     print(
@@ -451,10 +641,9 @@ def cli(
     )
 
     # get filed Rawhide BZs
-    filed_bugs = get_filed_bugs(bz, rawhide_tracking_bug)
     rawhide_open_bugs_components = {
         comp: bug.id
-        for bug in filed_bugs
+        for bug in rawhide_filed_bugs.result()
         if bug.status != "CLOSED"
         for comp in listify(bug.component)
     }
@@ -469,8 +658,9 @@ def cli(
     )
 
     # get map of all components
-    comps_subcomp = get_comps_subcomp(bz, config)
+    comps_subcomp = comps_subcomp.result()
 
+    pkgs_to_report = []
     for pkg in ftbfs_pkg_list:
         print("Checking package {}".format(pkg))
 
@@ -486,6 +676,17 @@ def cli(
             )
             continue
 
+        pkgs_to_report.append(pkg)
+
+    # look up the failed Koji builds of all remaining packages up front
+    task_ids = get_koji_failed_build_taskids(
+        ks,
+        pkgs_to_report,
+        config["koji_build_releasefilter"],
+        config["koji_build_epoch"],
+    )
+
+    for pkg in pkgs_to_report:
         print("Need to create BZ for package {}".format(pkg))
 
         if pkg in rawhide_open_bugs_components:
@@ -499,9 +700,7 @@ def cli(
         else:
             extrainfo = ""
 
-        task_id = get_koji_failed_build_taskid(
-            ks, pkg, config["koji_build_releasefilter"], config["koji_build_epoch"]
-        )
+        task_id = task_ids[pkg]
 
         if task_id:
             logs = get_koji_task_logs(ks, task_id)
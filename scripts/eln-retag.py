@@ -9,20 +9,13 @@ import re
 import rpm
 import sys
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
 
 logger = logging.getLogger(__name__)
 
 
-def check_retag(session, nvr, tag, dry_run=False):
-    buildinfo = session.getBuild(nvr)
-    logger.debug(f"Package name: {buildinfo['name']}")
-
-    # Look up latest tagged ENVR for this package
-    latest_tagged = session.listTagged(tag, latest=True, package=buildinfo["name"])
-
-    if len(latest_tagged) < 1 or compare_with_disttag(latest_tagged[0]["nvr"], nvr) < 0:
+def check_retag(nvr, tagged_nvr):
+    # tagged_nvr is the latest tagged NVR of this package, or None
+    if tagged_nvr is None or compare_with_disttag(tagged_nvr, nvr) < 0:
         # Tag this NVR
         return True
 
@@ -30,10 +23,18 @@ def check_retag(session, nvr, tag, dry_run=False):
     return False
 
 def compare_with_disttag(tagged_nvr, proposed_nvr):
+    # The proposed build is already the tagged one
+    if tagged_nvr == proposed_nvr:
+        return 0
+
     # First compare versions without the trailing dist tag
-    split_tagged_nvr = tagged_nvr.rsplit(".", maxsplit=1)
-    split_proposed_nvr = proposed_nvr.rsplit(".", maxsplit=1)
-    res = rpm.labelCompare(split_tagged_nvr[0], split_proposed_nvr[0])
+    tagged_base, sep, tagged_disttag = tagged_nvr.rpartition(".")
+    if not sep:
+        tagged_base, tagged_disttag = tagged_disttag, ""
+    proposed_base, sep, proposed_disttag = proposed_nvr.rpartition(".")
+    if not sep:
+        proposed_base, proposed_disttag = proposed_disttag, ""
+    res = rpm.labelCompare(tagged_base, proposed_base)
     if res < 0:
         # proposed_nvr is unambiguously higher
         return -1
@@ -42,7 +43,7 @@ def compare_with_disttag(tagged_nvr, proposed_nvr):
         return 1
 
     # Otherwise they are the same base version. Check for the disttag
-    if split_tagged_nvr[1].startswith("eln"):
+    if tagged_disttag.startswith("eln"):
         # The existing tagged build is the ELN build. Do nothing.
         return 0
 
@@ -119,20 +120,39 @@ def main():
 
     logger.info(f"Builds in tag: {len(latest_builds)}")
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_nvr = dict()
-
-        for nvr in retag_nvrs:
-            future = executor.submit(check_retag, session, nvr, args.tag, args.dry_run)
-            future_to_nvr[future] = nvr
-
-        with session.multicall(batch=500) as mc:
-            for future in as_completed(future_to_nvr):
-                nvr = future_to_nvr[future]
-                if future.result():
-                    logger.info(f"Will tag {nvr} into {args.tag}")
-                    if not args.dry_run:
-                        mc.tagBuild()
+    # Latest tagged ENVR for each package
+    latest_by_name = {build["name"]: build["nvr"] for build in latest_builds}
+
+    with session.multicall(batch=500) as mc:
+        buildinfos = [(nvr, mc.getBuild(nvr)) for nvr in retag_nvrs]
+
+    to_tag = []
+    for nvr, buildinfo in buildinfos:
+        if buildinfo.result is None:
+            logger.warning(f"Build {nvr} does not exist")
+            continue
+        logger.debug(f"Package name: {buildinfo.result['name']}")
+        if check_retag(nvr, latest_by_name.get(buildinfo.result["name"])):
+            logger.info(f"Will tag {nvr} into {args.tag}")
+            to_tag.append(nvr)
+
+    if args.dry_run or not to_tag:
+        return
+
+    session.gssapi_login()
+    with session.multicall(strict=False, batch=500) as mc:
+        calls = [(nvr, mc.tagBuild(args.tag, nvr)) for nvr in to_tag]
+
+    failed = 0
+    for nvr, call in calls:
+        try:
+            call.result
+        except koji.GenericError as e:
+            logger.error(f"Failed to tag {nvr}: {e}")
+            failed += 1
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,34 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import tempfile
+
+
+# Per-user cache directory shared by the ELN scripts
+CACHE_ROOT = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+
+
+def write_file_atomic(path, text):
+    """
+    Replaces the content of 'path' with 'text' so that readers never see
+    a partially written file.
+
+    :param path: file to write
+    :type path: str
+    :param text: new content of the file
+    :type text: str
+
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
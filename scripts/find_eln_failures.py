@@ -12,6 +12,9 @@ from collections import defaultdict
 
 logger = logging.getLogger('eln_analyzer')
 
+# number of Koji calls sent in a single multicall request
+KOJI_BATCH = 500
+
 
 def get_eln_builds(session):
     builds = session.listTagged('eln-rebuild', inherit=False)
@@ -21,6 +24,10 @@ def get_eln_builds(session):
     for build in builds:
         eln_builds[build['package_name']].append(build)
 
+    # Keep the newest build of each package first
+    for package_builds in eln_builds.values():
+        package_builds.sort(key=lambda build: build['task_id'] or 0, reverse=True)
+
     return eln_builds
 
 
@@ -28,7 +35,7 @@ def is_latest(eln_builds, package_name, task_id):
     """
     Determine whether the failed task is the most recent one attempted for this package
 
-    :param eln_builds: Dictionary of ELN builds ( package_name->[build1, ..., buildN] )
+    :param eln_builds: Dictionary of ELN builds ( package_name->[build1, ..., buildN] ), newest first
     :param package_name: The name of the package
     :param task_id: The task ID of the failed build
     :return: True if no newer build has succeeded and been tagged into eln-rebuild. False if at least one build has
@@ -42,19 +49,23 @@ def is_latest(eln_builds, package_name, task_id):
 
     # Hack: since task_id is monotonically increasing, we can assume that a build with a higher task_id must be newer.
     # Therefore if such an ID exists in the list of candidates, we can return False here, since a newer build must have
-    # succeeded to be tagged into eln[-rebuild].
-    logger.debug("eln_builds for {}: {}".format(package_name, eln_builds[package_name]))
-    for candidate in eln_builds[package_name]:
-        logger.debug("Existing tagged build of {}: {}".format(package_name, candidate))
-        return False
+    # succeeded to be tagged into eln[-rebuild]. The builds are sorted newest first, so only the first one matters.
+    newest = eln_builds[package_name][0]
+    logger.debug("Newest tagged build of {}: {}".format(package_name, newest))
 
-    return True
+    return (newest['task_id'] or 0) <= task_id
 
 
-def get_failure_details(session, task_id):
+def get_failure_details(task_id, descendents):
+    """
+    Collect the failed subtasks of a task
+
+    :param task_id: The task ID of the failed build
+    :param descendents: The result of getTaskDescendents for the task
+    :return: Dictionary of failed subtasks ( subtask_id->{label->subtask} )
+    """
     details = defaultdict(dict)
 
-    descendents = session.getTaskDescendents(task_id)
     for subtask in descendents[str(task_id)]:
         if subtask['state'] == koji.TASK_STATES['FAILED']:
             details[subtask['id']][subtask['label']] = subtask
@@ -122,8 +133,16 @@ def cli(debug, fas_user, koji_url, output_format, release_filter):
             continue
 
         logger.debug("{} is a failed build".format(candidate['nvr']))
-        failed_builds[package_name] = {'task_id': candidate['task_id'],
-                                       'subtasks': get_failure_details(session, candidate['task_id'])}
+        failed_builds[package_name] = {'task_id': candidate['task_id']}
+
+    # Fetch the subtasks of all failed builds at once
+    with session.multicall(batch=KOJI_BATCH) as m:
+        descendents = {package_name: m.getTaskDescendents(failed_build['task_id'])
+                       for package_name, failed_build in failed_builds.items()}
+
+    for package_name, failed_build in failed_builds.items():
+        failed_build['subtasks'] = get_failure_details(failed_build['task_id'],
+                                                       descendents[package_name].result)
 
     # Output the failed builds
     if output_format == 'json':
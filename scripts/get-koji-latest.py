@@ -8,8 +8,6 @@ import os
 import re
 import sys
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
 
 logger = logging.getLogger(__name__)
 
@@ -72,7 +70,7 @@ def main():
     spkg_list = {}
 
     with open(args.filterfile) as filterfile:
-        filter_packagenames = filterfile.read().splitlines()
+        filter_packagenames = frozenset(filterfile.read().splitlines())
 
     session = koji.ClientSession(args.kojihub)
     latest_builds = session.listTagged(args.tag, latest=True)
@@ -89,26 +87,22 @@ def main():
     logger.debug(f"Filtered builds: {filtered_builds}")
     logger.info(f"Filtered builds: {len(filtered_builds)}")
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_build_source = dict()
-
-        for build in filtered_builds:
-            future = executor.submit(
-                get_build_source, session, build["name"], build["nvr"]
-            )
-            future_to_build_source[future] = build["nvr"]
+    with session.multicall(batch=500) as mc:
+        buildinfos = [
+            (build["name"], build["nvr"], mc.getBuild(build["nvr"]))
+            for build in filtered_builds
+        ]
 
-        for future in as_completed(future_to_build_source):
-            result = future.result()
-            logger.debug(result)
-            spkg_list[result["name"]] = result
+    for name, nvr, buildinfo in buildinfos:
+        result = get_build_source(name, nvr, buildinfo.result)
+        logger.debug(result)
+        spkg_list[result["name"]] = result
 
     with open(args.outfile, "w") as json_file:
         json.dump(spkg_list, json_file, indent=2, sort_keys=True)
 
 
-def get_build_source(session, name, nvr):
-    buildinfo = session.getBuild(nvr)
+def get_build_source(name, nvr, buildinfo):
     logger.debug(f"Build source: {buildinfo['source']}")
     return {"name": name, "nvr": nvr, "githash": buildinfo["source"]}
 
@@ -1,12 +1,122 @@
 # SPDX-License-Identifier: MIT
 
+import hashlib
+import json
 import logging
 import os
 import requests
 import sys
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def get_distro_packages(distro_url, distro_view, arches, logger=None):
+from file_cache import CACHE_ROOT, write_file_atomic
+
+
+WHICH_SOURCE = ["source", "buildroot-source"]
+
+# Default location for cached content resolver data
+CACHE_DIR = os.path.join(CACHE_ROOT, "eln")
+
+# (connect, read) timeouts in seconds for content resolver downloads
+TIMEOUT = (5, 30)
+
+# Connections kept per host, also the cap on concurrent downloads
+POOL_SIZE = 8
+
+
+def get_session():
+    """
+    Creates a requests session which keeps its connections alive and
+    retries failed requests.
+
+    :return: new session
+    :rtype: requests.Session
+
+    """
+    adapter = HTTPAdapter(
+        pool_connections=POOL_SIZE,
+        pool_maxsize=POOL_SIZE,
+        max_retries=Retry(total=3, backoff_factor=0.5),
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by all downloads so that they reuse keep-alive connections
+SESSION = get_session()
+
+
+def get_package_list(url, session, cache_dir=None, logger=None):
+    """
+    Downloads a single content resolver package name list, reading it
+    line by line as it arrives.
+
+    With a 'cache_dir', the list is stored there together with its ETag and
+    Last-Modified headers, and later downloads are conditional requests
+    which reuse the stored list when the server reports it unchanged.
+
+    :param url: URL of the package name list
+    :type url: str
+    :param session: session to download with
+    :type session: requests.Session
+    :param cache_dir: directory to cache the list in, or None for no caching
+    :type cache_dir: str
+    :param logger: logger instance for cache warnings
+    :type logger: logging.Logger
+    :return: package names in the list
+    :rtype: set
+
+    """
+    headers = {}
+
+    if cache_dir:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        body_path = os.path.join(cache_dir, key + ".body")
+        meta_path = os.path.join(cache_dir, key + ".meta")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if os.path.exists(body_path):
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+        except (OSError, ValueError):
+            pass
+
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+        if r.status_code == 304:
+            with open(body_path) as f:
+                return set(map(sys.intern, filter(None, f.read().splitlines())))
+
+        r.raise_for_status()
+        # Work around empty lines in Content Resolver output, if present.
+        package_list = set(
+            map(sys.intern, filter(None, r.iter_lines(decode_unicode=True)))
+        )
+        meta = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+
+    if cache_dir and (meta["etag"] or meta["last_modified"]):
+        # the cache only saves downloads, so a failed write is not fatal
+        try:
+            write_file_atomic(body_path, "\n".join(sorted(package_list)))
+            write_file_atomic(meta_path, json.dumps(meta))
+        except OSError as e:
+            if logger:
+                logger.warning("Could not cache %s: %s", url, e)
+
+    return package_list
+
+
+def get_distro_packages(distro_url, distro_view, arches, logger=None, session=None,
+                        cache_dir=None, cache_ttl=0):
     """
     Fetches the list of desired sources for 'distro-view' from 'distro-url'
     for each of the given 'arches'.
@@ -19,33 +129,73 @@ def get_distro_packages(distro_url, distro_view, arches, logger=None):
     :type arches: iterable
     :param logger: logger instance for debug output
     :type logger: logging.Logger
+    :param session: session to download with, the shared SESSION by default
+    :type session: requests.Session
+    :param cache_dir: directory to cache the downloaded lists in, see get_package_list()
+    :type cache_dir: str
+    :param cache_ttl: seconds to reuse the merged result cached in 'cache_dir'
+        without downloading anything, 0 to always download
+    :type cache_ttl: int
     :return: list of packages that are desired, merged for all 'arches'
-    :rtype: set
+    :rtype: frozenset
 
     """
-    merged_packages = set()
-
-    for arch in arches:
-      for this_source in which_source:
-        url = (
+    if session is None:
+        session = SESSION
+
+    if cache_dir:
+        key = hashlib.sha1(
+            " ".join([distro_url] + sorted(arches)).encode()
+        ).hexdigest()
+        merged_path = os.path.join(
+            cache_dir, "desired_pkgs.{}.{}.json".format(distro_view, key)
+        )
+        try:
+            if time.time() - os.path.getmtime(merged_path) < cache_ttl:
+                with open(merged_path) as f:
+                    merged_packages = frozenset(map(sys.intern, json.load(f)))
+                if logger:
+                    logger.debug("Using %d cached packages from %s",
+                                 len(merged_packages), merged_path)
+                return merged_packages
+        except (OSError, ValueError):
+            pass
+
+    urls = [
+        (
             "{distro_url}"
             "/view-{this_source}-package-name-list--view-{distro_view}--{arch}.txt"
         ).format(distro_url=distro_url, this_source=this_source, distro_view=distro_view, arch=arch)
+        for arch in arches
+        for this_source in WHICH_SOURCE
+    ]
 
-        if logger:
-            logger.debug("downloading {url}".format(url=url))
+    if logger:
+        for url in urls:
+            logger.debug("downloading %s", url)
 
-        r = requests.get(url, allow_redirects=True)
-        for line in r.text.splitlines():
-            # Work around empty lines in Content Resolver output, if present.
-            if not line:
-                continue
-            merged_packages.add(line)
+    # the lists are independent, download them all at once
+    with ThreadPoolExecutor(max_workers=min(len(urls), POOL_SIZE) or 1) as executor:
+        package_lists = executor.map(
+            lambda url: get_package_list(url, session, cache_dir, logger), urls
+        )
+
+    merged_packages = set()
+
+    for package_list in package_lists:
+        merged_packages.update(package_list)
 
     if logger:
-        logger.debug("Found a total of {} packages".format(len(merged_packages)))
+        logger.debug("Found a total of %d packages", len(merged_packages))
+
+    if cache_dir and cache_ttl > 0:
+        try:
+            write_file_atomic(merged_path, json.dumps(sorted(merged_packages)))
+        except OSError as e:
+            if logger:
+                logger.warning("Could not cache desired packages: %s", e)
 
-    return merged_packages
+    return frozenset(merged_packages)
 
 if __name__ == "__main__":
     logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
@@ -56,7 +206,6 @@ if __name__ == "__main__":
     distro_url = "https://tiny.distro.builders"
     distro_view = "eln"
     arches = ["aarch64", "ppc64le", "s390x", "x86_64"]
-    which_source = ["source", "buildroot-source"]
 
     if len(sys.argv) == 2 and sys.argv[1] == "--help":
         print("Usage: {} [ distro-view [ distro-url [ 'arches' ] ] ]".format(sys.argv[0]))
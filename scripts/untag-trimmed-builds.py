@@ -6,9 +6,14 @@ import click
 import koji
 import logging
 import os
+import requests
 import sys
+import time
 
-from get_distro_packages import get_distro_packages
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+from get_distro_packages import CACHE_DIR, get_distro_packages
 
 
 logger = logging.getLogger(os.path.basename(__file__))
@@ -19,58 +24,89 @@ logger = logging.getLogger(os.path.basename(__file__))
 # then the --force option must be supplied to complete the untagging operation
 FORCE_THRESHOLD = 0.5
 
+# extracts (package name, nvr) from a Koji build info
+get_pkg_nvr = itemgetter("package_name", "nvr")
+
+# reuse the hub connection, and retry anonymous calls on transient errors
+KOJI_OPTS = {"keepalive": True, "timeout": 600, "anon_retry": True, "max_retries": 3}
+
+# number of attempts to log in to Koji before giving up
+LOGIN_ATTEMPTS = 3
+
+# number of untagBuild calls sent to Koji in a single multicall
+BATCH_SIZE = 100
+
 
-def get_undesired_builds(session, koji_tag, desired_pkgs, force):
+def get_tagged_builds(session, koji_tag):
     """
-    Fetches the list of undesired builds currently tagged with
-    'koji_tag'.
+    Fetches the list of all builds currently tagged with 'koji_tag'.
 
     :param session: Koji session
     :type session: koji.ClientSession
     :param koji_tag: Koji tag
     :type koji_tag: str
+    :return: list of Koji build infos, or None if there is no such tag
+    :rtype: list
+    """
+    # look up the tag and all builds with tag in one request
+    with session.multicall() as m:
+        tag_call = m.getTag(koji_tag)
+        builds_call = m.listTagged(koji_tag)
+
+    tag = tag_call.result
+    if not tag:
+        logger.error("No such tag %s", koji_tag)
+        return None
+
+    return builds_call.result
+
+
+def get_undesired_builds(koji_tag, builds, desired_pkgs, force):
+    """
+    Selects the undesired builds among the builds currently tagged with
+    'koji_tag'.
+
+    :param koji_tag: Koji tag
+    :type koji_tag: str
+    :param builds: list of Koji build infos of builds with tag
+    :type builds: list
     :param desired_pkgs: list of packages to keep
     :type desired_pkgs: set
     :return: list of NVRs of builds that should be deleted from tag,
         or None if an error occurred
     :rtype: set
     """
-    print(
-        "Identifying undesirable builds in Koji tag {koji_tag}".format(
-            koji_tag=koji_tag
-        )
-    )
-
-    tag = session.getTag(koji_tag)
-    if not tag:
-        print("No such tag {}".format(koji_tag))
-        return None
-
-    undesired_builds = set()
+    logger.info("Identifying undesirable builds in Koji tag %s", koji_tag)
 
-    # get all builds with tag
-    builds = session.listTagged(koji_tag)
     num_current_builds = len(builds)
 
     # if no current builds, none are undesired so return empty set
     if num_current_builds == 0:
-        return undesired_builds
-
-    for binfo in builds:
-        pkg = binfo["package_name"]
-        nvr = binfo["nvr"]
-
-        logger.debug("Found build of package {} with nvr {}".format(pkg, nvr))
-
-        if pkg not in desired_pkgs:
-            logger.debug("PACKAGE BUILD {} NEEDS TO BE REMOVED FROM TAG".format(nvr))
-
-            undesired_builds.add(nvr)
+        return set()
+
+    undesired_builds = {
+        nvr for pkg, nvr in map(get_pkg_nvr, builds) if pkg not in desired_pkgs
+    }
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Found builds:\n{}".format(
+                "\n".join(
+                    "{} ({})".format(binfo["nvr"], binfo["package_name"])
+                    for binfo in builds
+                )
+            )
+        )
+        logger.debug(
+            "PACKAGE BUILDS NEED TO BE REMOVED FROM TAG:\n{}".format(
+                "\n".join(sorted(undesired_builds))
+            )
+        )
 
     num_undesired_builds = len(undesired_builds)
     undesired_ratio = num_undesired_builds / num_current_builds
 
-    print(
+    logger.info(
         "Koji tag {} currently has {} builds, {} ({:.2%}) of which are undesired".format(
             koji_tag,
             num_current_builds,
@@ -80,40 +116,139 @@ def get_undesired_builds(session, koji_tag, desired_pkgs, force):
     )
 
     if undesired_ratio > FORCE_THRESHOLD:
-        print(
-            "WARNING: Undesired build ratio is above safety threshold"
+        logger.warning(
+            "Undesired build ratio is above safety threshold"
             " ({:.2%})".format(FORCE_THRESHOLD)
         )
         if force:
-            print("--force option has been set. Proceeding.")
+            logger.warning("--force option has been set. Proceeding.")
         else:
-            print(
-                "Use --force option if you wish to proceed despite this warning.",
-                file=sys.stderr
+            logger.error(
+                "Use --force option if you wish to proceed despite this warning."
             )
             return None
 
     return undesired_builds
 
 
-def untag_builds(session, koji_tag, dry_run, builds):
+def untag_builds(session, koji_tag, dry_run, builds, batch_size=BATCH_SIZE):
     """
     Untag given list of builds from 'koji_tag'.
 
+    The builds are untagged in multicalls of at most 'batch_size' calls,
+    so that a failing call only affects its own batch.
+
     :param session: Koji session
     :type session: koji.ClientSession
     :param koji_tag: Koji tag
     :type koji_tag: str
     :param builds: list of builds to untag
     :type desired_pkgs: set
+    :param batch_size: number of builds untagged per multicall
+    :type batch_size: int
+    :return: number of builds which failed to untag
+    :rtype: int
     """
-    with session.multicall() as m:
-        for nvr in sorted(builds):
-            if dry_run:
-                print("Would have untagged {}".format(nvr))
+    sorted_nvrs = sorted(builds)
+    untagged = 0
+    failed = 0
+
+    for start in range(0, len(sorted_nvrs), batch_size):
+        batch = sorted_nvrs[start:start + batch_size]
+
+        if dry_run:
+            for nvr in batch:
+                logger.info("Would have untagged %s", nvr)
+            continue
+
+        with session.multicall(strict=False) as m:
+            calls = []
+            for nvr in batch:
+                logger.debug("Untagging %s", nvr)
+                calls.append((nvr, m.untagBuild(koji_tag, nvr)))
+
+        for nvr, call in calls:
+            try:
+                call.result
+            except koji.GenericError as e:
+                logger.error("Failed to untag %s: %s", nvr, e)
+                failed += 1
             else:
-                print("Untagging {}".format(nvr))
-                m.untagBuild(koji_tag, nvr)
+                untagged += 1
+
+        logger.info(
+            "Untagged %d of %d builds from %s",
+            untagged, len(sorted_nvrs), koji_tag
+        )
+
+    if failed:
+        logger.error("Failed to untag %d builds from %s", failed, koji_tag)
+
+    return failed
+
+
+def untag_builds_parallel(koji_url, koji_tag, builds, batch_size, parallel):
+    """
+    Untag given list of builds from 'koji_tag' over 'parallel' separately
+    logged in Koji sessions, each untagging its own share of the builds.
+
+    :param koji_url: the root of the Koji XMLRPC API
+    :type koji_url: str
+    :param koji_tag: Koji tag
+    :type koji_tag: str
+    :param builds: list of builds to untag
+    :type builds: set
+    :param batch_size: number of builds untagged per multicall
+    :type batch_size: int
+    :param parallel: number of concurrent Koji sessions
+    :type parallel: int
+    :return: number of builds which failed to untag
+    :rtype: int
+    """
+    sorted_nvrs = sorted(builds)
+    shares = [sorted_nvrs[i::parallel] for i in range(parallel)]
+
+    def untag_share(share):
+        session = koji_login(koji_url)
+        if session is None:
+            logger.error("Failed to untag %d builds", len(share))
+            return len(share)
+        return untag_builds(session, koji_tag, False, share, batch_size)
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        # summing the results also re-raises any exception from the workers
+        return sum(executor.map(untag_share, [share for share in shares if share]))
+
+
+def koji_login(koji_url):
+    """
+    Creates a Koji session and logs in using GSSAPI. Failed logins are
+    retried with exponential backoff.
+
+    :param koji_url: the root of the Koji XMLRPC API
+    :type koji_url: str
+    :return: logged in Koji session, or None if the login failed
+    :rtype: koji.ClientSession
+    """
+    session = koji.ClientSession(koji_url, opts=dict(KOJI_OPTS))
+
+    for attempt in range(LOGIN_ATTEMPTS):
+        try:
+            session.gssapi_login()
+            break
+        except Exception as e:
+            logger.error("An authentication error has occurred: %s", e)
+            if attempt + 1 < LOGIN_ATTEMPTS:
+                time.sleep(0.5 * 2 ** attempt)
+
+    if not session.logged_in:
+        logger.error(
+            "Unable to log in to Koji."
+            " Did you forget to run 'kinit fasname@FEDORAPROJECT.ORG'?"
+        )
+        return None
+
+    return session
 
 
 @click.command()
@@ -155,47 +290,96 @@ def untag_builds(session, koji_tag, dry_run, builds):
                   " threshold ({:.2%})").format(FORCE_THRESHOLD),
               show_default=True,
               default=False)
-def cli(dry_run, debug, koji_url, koji_tag, distro_url, distro_view, arches, force):
+@click.option("--batch-size",
+              type=click.IntRange(min=1),
+              help="The number of builds to untag per Koji multicall",
+              show_default=True,
+              default=BATCH_SIZE)
+@click.option("--cache-dir",
+              help="Where to cache the content resolver lists, empty to disable",
+              show_default=True,
+              default=CACHE_DIR)
+@click.option("--cache-ttl",
+              type=click.IntRange(min=0),
+              help="Seconds to reuse the cached desired packages without"
+                   " checking the content resolver, 0 to always check",
+              show_default=True,
+              default=600)
+@click.option("--parallel",
+              type=click.IntRange(min=1),
+              help="The number of Koji sessions untagging builds concurrently",
+              show_default=True,
+              default=1)
+def cli(dry_run, debug, koji_url, koji_tag, distro_url, distro_view, arches, force,
+        batch_size, cache_dir, cache_ttl, parallel):
     """
     Automated removal of packages from koji tag that have been trimmed from
     distribution.
+
+    Logs in to Koji with the Kerberos ticket obtained by kinit. Set
+    KRB5CCNAME if the ticket is not in the default credentials cache.
     """
     if debug:
         logging.basicConfig(format="%(asctime)s:%(levelname)s:%(name)s:%(message)s")
         logger.setLevel(logging.DEBUG)
         logger.debug("Debugging mode enabled")
     else:
-        logging.basicConfig()
-
-    session = koji.ClientSession(koji_url)
-    try:
-        session.gssapi_login()
-    except:
-        print("ERROR: an authentication error has occurred", file=sys.stderr)
-    if not session.logged_in:
-        print(
-            "Unable to log in to Koji."
-            " Did you forget to run 'kinit fasname@FEDORAPROJECT.ORG'?",
-            file=sys.stderr
+        # plain status lines on stderr, keeping stdout free for piping
+        logging.basicConfig(format="%(levelname)s: %(message)s")
+        logger.setLevel(logging.INFO)
+
+    # the content resolver download does not need Koji, so run it while
+    # logging in
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        logger.info(
+            "Downloading and merging desired %s sources for arches: %s",
+            distro_view, ", ".join(arches)
         )
-        return
-
-    print(
-        "Downloading and merging desired {distro_view} sources"
-        " for arches: {arches}".format(
-            distro_view=distro_view, arches=", ".join(arches)
+        desired_pkgs_future = executor.submit(
+            get_distro_packages,
+            distro_url, distro_view, arches,
+            logger=logger, cache_dir=cache_dir, cache_ttl=cache_ttl
         )
-    )
-    desired_pkgs = get_distro_packages(distro_url, distro_view, arches, logger=logger)
 
-    builds_to_untag = get_undesired_builds(session, koji_tag, desired_pkgs, force)
+        session = koji_login(koji_url)
+        if session is None:
+            sys.exit(1)
+
+        # the tagged builds do not depend on the download either
+        builds_future = executor.submit(get_tagged_builds, session, koji_tag)
+
+        try:
+            desired_pkgs = desired_pkgs_future.result()
+        except requests.RequestException as e:
+            logger.error("Failed to download desired %s packages: %s",
+                         distro_view, e)
+            sys.exit(1)
+        builds = builds_future.result()
+
+    # without any desired packages every build would look undesired
+    if not desired_pkgs:
+        logger.error("No desired %s packages found; aborting", distro_view)
+        sys.exit(1)
+
+    if builds is None:
+        sys.exit(1)
+
+    builds_to_untag = get_undesired_builds(koji_tag, builds, desired_pkgs, force)
     if not builds_to_untag:
-        print("No builds to untag")
+        logger.info("No builds to untag")
         return
 
-    logger.debug("Builds to untag: {}".format(builds_to_untag))
+    logger.debug("Builds to untag: %s", builds_to_untag)
+
+    if parallel > 1 and not dry_run:
+        failed = untag_builds_parallel(
+            koji_url, koji_tag, builds_to_untag, batch_size, parallel
+        )
+    else:
+        failed = untag_builds(session, koji_tag, dry_run, builds_to_untag, batch_size)
 
-    untag_builds(session, koji_tag, dry_run, builds_to_untag)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":